@@ -1,15 +1,57 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename
+from sqlalchemy import event
+from PIL import Image, UnidentifiedImageError
+from collections import OrderedDict
 from datetime import datetime, timedelta
+import calendar
+import click
+import gzip
+import hashlib
+import math
+import mimetypes
 import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'chave-secreta-barbearia'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(app.instance_path, 'barbearia.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Controle de admissão das rotas públicas
+app.config['RATE_LIMIT_ATIVO'] = os.environ.get('RATE_LIMIT_ATIVO', '1') == '1'
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND', 'memoria') # memoria ou sqlite (compartilhado entre workers)
+app.config['RATE_LIMIT_SQLITE'] = os.environ.get('RATE_LIMIT_SQLITE', os.path.join(app.instance_path, 'rate_limit.db'))
+app.config['DB_LATENCIA_LIMITE_MS'] = float(os.environ.get('DB_LATENCIA_LIMITE_MS', 250))
+# No Heroku (variável DYNO presente) o roteador é sempre o único proxy na frente da aplicação
+app.config['PROXIES_CONFIAVEIS'] = int(os.environ.get('PROXIES_CONFIAVEIS', 1 if 'DYNO' in os.environ else 0))
+
+# Arquivos estáticos: uploads de até 5 MB e X-Sendfile opcional quando há Apache/lighttpd na frente
+app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0') == '1'
+app.config['ASSETS_CACHE_SEGUNDOS'] = 365 * 24 * 3600
+
+# Long-poll do feed da fila: ligado automaticamente pelo asgi.py, ou via variável quando
+# o proxy encaminha /api/ para o uvicorn e as páginas para o gunicorn
+app.config['FILA_LONG_POLL'] = os.environ.get('FILA_LONG_POLL', '0') == '1'
+
+if app.config['PROXIES_CONFIAVEIS']:
+    # Sem isso todo cliente atrás do roteador compartilharia o mesmo IP
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXIES_CONFIAVEIS'])
+
 db = SQLAlchemy(app)
 
 # Configuração do Login
@@ -28,10 +70,12 @@ class Configuracao(db.Model):
     fidelidade_ativa = db.Column(db.Boolean, default=True)
     fidelidade_cortes_necessarios = db.Column(db.Integer, default=10)
     notificacao_minutos = db.Column(db.Integer, default=15)
+    fila_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0') # incrementado a cada mudança na fila
     
     usuarios = db.relationship('Usuario', backref='barbearia', lazy=True, cascade="all, delete-orphan")
     clientes = db.relationship('Cliente', backref='barbearia', lazy=True, cascade="all, delete-orphan")
     servicos = db.relationship('Servico', backref='barbearia', lazy=True, cascade="all, delete-orphan")
+    recorrencias = db.relationship('Recorrencia', backref='barbearia', lazy=True, cascade="all, delete-orphan")
 
 class Usuario(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -52,6 +96,8 @@ class Cliente(UserMixin, db.Model):
     is_admin = db.Column(db.Boolean, default=False)
     
     agendamentos = db.relationship('Agendamento', backref='cliente', lazy=True, cascade="all, delete-orphan")
+    lancamentos_fidelidade = db.relationship('FidelidadeLancamento', backref='cliente', lazy=True, cascade="all, delete-orphan")
+    recorrencias = db.relationship('Recorrencia', backref='cliente', lazy=True, cascade="all, delete-orphan")
     __table_args__ = (db.UniqueConstraint('telefone', 'barbearia_id', name='_telefone_barbearia_uc'),)
 
 class Servico(db.Model):
@@ -69,10 +115,25 @@ class Agendamento(db.Model):
     status = db.Column(db.String(20), default='Pendente')
     barbearia_id = db.Column(db.Integer, db.ForeignKey('configuracao.id'), nullable=False)
     barbeiro_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=True)
+    recorrencia_id = db.Column(db.Integer, db.ForeignKey('recorrencia.id'), nullable=True, index=True)
     
     servico = db.relationship('Servico')
     barbeiro = db.relationship('Usuario')
 
+class Recorrencia(db.Model):
+    # Regra de agendamento recorrente; as ocorrências são linhas de Agendamento com recorrencia_id
+    id = db.Column(db.Integer, primary_key=True)
+    barbearia_id = db.Column(db.Integer, db.ForeignKey('configuracao.id'), nullable=False)
+    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=False)
+    frequencia = db.Column(db.String(20), nullable=False) # semanal, quinzenal, mensal
+    data_inicio = db.Column(db.DateTime, nullable=False)
+    data_fim = db.Column(db.Date, nullable=True)
+    quantidade = db.Column(db.Integer, nullable=True)
+    criado_em = db.Column(db.DateTime, default=datetime.now)
+
+    # Ao excluir a regra, as ocorrências que sobrarem apenas deixam de apontar para ela
+    agendamentos = db.relationship('Agendamento', backref='recorrencia', lazy=True)
+
 class Fila(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     cliente_nome = db.Column(db.String(100), nullable=False)
@@ -83,9 +144,45 @@ class Fila(db.Model):
     posicao = db.Column(db.Integer)
     criado_em = db.Column(db.DateTime, default=datetime.now)
     barbeiro_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=True)
+    seq = db.Column(db.Integer, nullable=False, default=0, server_default='0') # última mudança (ver Configuracao.fila_seq)
+    seq_inicial = db.Column(db.Integer, nullable=False, default=0, server_default='0') # seq em que entrou na fila
     
     servico = db.relationship('Servico')
     barbeiro = db.relationship('Usuario')
+    __table_args__ = (db.Index('ix_fila_barbearia_seq', 'barbearia_id', 'seq'),)
+
+class FidelidadeLancamento(db.Model):
+    # Extrato de fidelidade (somente inserção). cortes_realizados e fidelidade_pontos do Cliente
+    # são apenas o saldo em cache da soma destes lançamentos.
+    id = db.Column(db.Integer, primary_key=True)
+    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=False, index=True)
+    barbearia_id = db.Column(db.Integer, db.ForeignKey('configuracao.id'), nullable=False)
+    agendamento_id = db.Column(db.Integer, db.ForeignKey('agendamento.id'), nullable=True)
+    tipo = db.Column(db.String(20), nullable=False) # abertura, credito, resgate
+    cortes = db.Column(db.Integer, default=0)
+    pontos = db.Column(db.Integer, default=0)
+    criado_em = db.Column(db.DateTime, default=datetime.now)
+
+@event.listens_for(db.session, 'before_flush')
+def numerar_mudancas_fila(sessao, contexto, instancias):
+    # Cada inserção/alteração em Fila recebe o próximo número da sequência da barbearia,
+    # usado pelo feed incremental (/api/<slug>/fila/feed?since=<seq>)
+    por_barbearia = {}
+    for obj in list(sessao.new) + list(sessao.dirty):
+        if isinstance(obj, Fila) and (obj in sessao.new or sessao.is_modified(obj)):
+            por_barbearia.setdefault(int(obj.barbearia_id), []).append(obj)
+
+    for barbearia_id, itens in por_barbearia.items():
+        ultimo = sessao.execute(
+            db.update(Configuracao.__table__)
+            .where(Configuracao.__table__.c.id == barbearia_id)
+            .values(fila_seq=Configuracao.__table__.c.fila_seq + len(itens))
+            .returning(Configuracao.__table__.c.fila_seq)
+        ).scalar_one()
+        for numero, item in enumerate(itens, start=ultimo - len(itens) + 1):
+            item.seq = numero
+            if item in sessao.new:
+                item.seq_inicial = numero
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -102,9 +199,131 @@ def load_user(user_id):
         return user
     return Cliente.query.get(int(user_id))
 
+def migrar_colunas():
+    """O create_all não altera tabelas que já existem; aqui criamos as colunas e índices novos dos modelos."""
+    inspetor = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for tabela in db.metadata.sorted_tables:
+            existentes = {c['name'] for c in inspetor.get_columns(tabela.name)}
+            for coluna in tabela.columns:
+                if coluna.name in existentes:
+                    continue
+                tipo = coluna.type.compile(dialect=db.engine.dialect)
+                padrao = f' DEFAULT {coluna.server_default.arg}' if coluna.server_default is not None else ''
+                conn.execute(db.text(f'ALTER TABLE {tabela.name} ADD COLUMN {coluna.name} {tipo}{padrao}'))
+            for indice in tabela.indexes:
+                indice.create(conn, checkfirst=True)
+
+# --- FIDELIDADE ---
+def abrir_extratos_fidelidade():
+    # Clientes anteriores ao extrato: o saldo atual vira um lançamento de abertura
+    sem_extrato = ~db.exists().where(FidelidadeLancamento.cliente_id == Cliente.id)
+    consulta = db.select(
+        Cliente.id, Cliente.barbearia_id, db.literal('abertura'), db.func.coalesce(Cliente.cortes_realizados, 0),
+        db.func.coalesce(Cliente.fidelidade_pontos, 0), db.literal(datetime.now())
+    ).where(sem_extrato, db.or_(Cliente.cortes_realizados != 0, Cliente.fidelidade_pontos != 0))
+    db.session.execute(db.insert(FidelidadeLancamento).from_select(
+        ['cliente_id', 'barbearia_id', 'tipo', 'cortes', 'pontos', 'criado_em'], consulta
+    ))
+    db.session.commit()
+
+def registrar_corte(config, cliente_id, agendamento_id):
+    """Credita um corte no extrato e atualiza o saldo com incremento atômico no banco.
+    Retorna True se o cliente completou os cortes necessários para o prêmio."""
+    clientes = Cliente.__table__
+    pontos = 1 if config.fidelidade_ativa else 0
+    lancamentos = [dict(cliente_id=cliente_id, barbearia_id=config.id, agendamento_id=agendamento_id,
+                        tipo='credito', cortes=1, pontos=pontos, criado_em=datetime.now())]
+    saldo = db.session.execute(
+        db.update(clientes).where(clientes.c.id == cliente_id).values(
+            cortes_realizados=clientes.c.cortes_realizados + 1,
+            fidelidade_pontos=clientes.c.fidelidade_pontos + pontos
+        ).returning(clientes.c.fidelidade_pontos)
+    ).scalar_one()
+
+    premiado = False
+    necessarios = config.fidelidade_cortes_necessarios
+    if config.fidelidade_ativa and saldo >= necessarios:
+        # O WHERE garante que só uma conclusão concorrente efetua o resgate
+        premiado = db.session.execute(
+            db.update(clientes).where(clientes.c.id == cliente_id, clientes.c.fidelidade_pontos >= necessarios)
+            .values(fidelidade_pontos=clientes.c.fidelidade_pontos - necessarios)
+        ).rowcount > 0
+        if premiado:
+            lancamentos.append(dict(cliente_id=cliente_id, barbearia_id=config.id, agendamento_id=agendamento_id,
+                                    tipo='resgate', cortes=0, pontos=-necessarios, criado_em=datetime.now()))
+    db.session.execute(db.insert(FidelidadeLancamento), lancamentos)
+    return premiado
+
+def reavaliar_fidelidade(config):
+    """Aplica em lote um novo fidelidade_cortes_necessarios: quem já tem pontos suficientes ganha o prêmio."""
+    necessarios = config.fidelidade_cortes_necessarios
+    elegiveis = db.and_(Cliente.barbearia_id == config.id, Cliente.fidelidade_pontos >= necessarios)
+    db.session.execute(db.insert(FidelidadeLancamento).from_select(
+        ['cliente_id', 'barbearia_id', 'tipo', 'cortes', 'pontos', 'criado_em'],
+        db.select(Cliente.id, Cliente.barbearia_id, db.literal('resgate'), db.literal(0),
+                  db.literal(-necessarios), db.literal(datetime.now())).where(elegiveis)
+    ))
+    clientes = Cliente.__table__
+    return db.session.execute(
+        db.update(clientes).where(clientes.c.barbearia_id == config.id, clientes.c.fidelidade_pontos >= necessarios)
+        .values(fidelidade_pontos=clientes.c.fidelidade_pontos - necessarios)
+    ).rowcount
+
+def verificar_fidelidade(barbearia_id=None, corrigir=False):
+    """Compara o saldo em cache de cada cliente com a soma do extrato.
+    Retorna as divergências (id, cortes, pontos, cortes_extrato, pontos_extrato); com corrigir=True recalcula os saldos."""
+    somas = db.select(
+        FidelidadeLancamento.cliente_id,
+        db.func.sum(FidelidadeLancamento.cortes).label('cortes'),
+        db.func.sum(FidelidadeLancamento.pontos).label('pontos')
+    ).group_by(FidelidadeLancamento.cliente_id).subquery()
+    cortes_extrato = db.func.coalesce(somas.c.cortes, 0)
+    pontos_extrato = db.func.coalesce(somas.c.pontos, 0)
+    consulta = db.select(
+        Cliente.id, Cliente.cortes_realizados, Cliente.fidelidade_pontos, cortes_extrato, pontos_extrato
+    ).outerjoin(somas, somas.c.cliente_id == Cliente.id).where(
+        db.or_(Cliente.cortes_realizados != cortes_extrato, Cliente.fidelidade_pontos != pontos_extrato)
+    )
+    if barbearia_id is not None:
+        consulta = consulta.where(Cliente.barbearia_id == barbearia_id)
+    divergencias = db.session.execute(consulta).all()
+
+    if corrigir and divergencias:
+        clientes = Cliente.__table__
+        def soma(coluna):
+            return db.select(db.func.coalesce(db.func.sum(coluna), 0)).where(
+                FidelidadeLancamento.cliente_id == clientes.c.id
+            ).scalar_subquery()
+        db.session.execute(
+            db.update(clientes).where(clientes.c.id.in_([d[0] for d in divergencias])).values(
+                cortes_realizados=soma(FidelidadeLancamento.cortes),
+                fidelidade_pontos=soma(FidelidadeLancamento.pontos)
+            )
+        )
+        db.session.commit()
+    return divergencias
+
+@app.cli.command('verificar-fidelidade')
+@click.option('--slug', help='Verifica apenas esta barbearia.')
+@click.option('--corrigir', is_flag=True, help='Recalcula os saldos divergentes a partir do extrato.')
+def verificar_fidelidade_cmd(slug, corrigir):
+    barbearia_id = None
+    if slug:
+        config = Configuracao.query.filter_by(slug=slug).first()
+        if config is None:
+            raise click.BadParameter(f'barbearia "{slug}" não encontrada.', param_hint='--slug')
+        barbearia_id = config.id
+    divergencias = verificar_fidelidade(barbearia_id, corrigir)
+    for cliente_id, cortes, pontos, cortes_extrato, pontos_extrato in divergencias:
+        click.echo(f'Cliente {cliente_id}: cortes {cortes} (extrato {cortes_extrato}), pontos {pontos} (extrato {pontos_extrato})')
+    click.echo(f'{len(divergencias)} divergência(s)' + (' corrigida(s).' if corrigir and divergencias else '.'))
+
 # Inicialização do Banco de Dados
 with app.app_context():
     db.create_all()
+    migrar_colunas()
+    abrir_extratos_fidelidade()
     if not Usuario.query.filter_by(username='admin').first():
         admin = Usuario(
             username='admin',
@@ -115,6 +334,369 @@ with app.app_context():
         db.session.add(admin)
         db.session.commit()
 
+# --- CONTROLE DE ADMISSÃO (LIMITE POR CLIENTE E DESCARTE DE CARGA) ---
+# Orçamento por rota: endpoint -> (métodos limitados, capacidade do balde, janela em segundos).
+# O balde de cada IP/sessão recebe a capacidade cheia; o balde da barbearia (slug)
+# recebe LIMITE_FATOR_BARBEARIA vezes mais, para que um tenant não esgote o banco sozinho.
+LIMITES_ROTAS = {
+    'entrar_fila': (('POST',), 5, 300),
+    'agendar_cliente': (('POST',), 10, 300),
+    'horarios_ocupados': (('GET',), 30, 60),
+    # As páginas abaixo consultam sozinhas (a cada 10 s ou 30 s); o balde por IP comporta
+    # uns 20 celulares no mesmo Wi-Fi da barbearia, que saem todos pelo mesmo IP
+    'verificar_notificacoes': (('GET',), 40, 60),
+    'api_fila_status': (('GET',), 120, 60),
+    'api_agendamento_status': (('GET',), 120, 60),
+    'api_fila_feed': (('GET',), 240, 60), # várias TVs/tablets atrás do mesmo IP da barbearia
+}
+LIMITE_FATOR_BARBEARIA = 20
+# Rotas usadas por vários clientes na mesma rede (ex.: Wi-Fi da barbearia): sem balde por IP,
+# apenas por sessão e por barbearia
+ROTAS_SEM_LIMITE_IP = {'entrar_fila'}
+
+class BaldeMemoria:
+    """Token bucket em memória, válido apenas dentro de um processo."""
+    MAX_CHAVES = 50000
+
+    def __init__(self):
+        self.baldes = OrderedDict() # do menos para o mais recentemente usado
+        self.lock = threading.Lock()
+
+    def consumir(self, chave, capacidade, janela):
+        taxa = capacidade / janela
+        agora = time.monotonic()
+        with self.lock:
+            tokens, ultimo = self.baldes.pop(chave, (capacidade, agora))
+            tokens = min(capacidade, tokens + (agora - ultimo) * taxa)
+            permitido = tokens >= 1
+            if permitido:
+                tokens -= 1
+            self.baldes[chave] = (tokens, agora)
+            if len(self.baldes) > self.MAX_CHAVES:
+                # Sai o balde usado há mais tempo (LRU): custo constante, mesmo com todos recentes
+                self.baldes.popitem(last=False)
+        return permitido, tokens, (1 - tokens) / taxa if not permitido else 0
+
+class BaldeSQLite:
+    """Token bucket num arquivo SQLite local, compartilhado pelos workers da mesma máquina."""
+    LIMPAR_A_CADA = 1000
+    MAX_CHAVES = BaldeMemoria.MAX_CHAVES
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.local = threading.local()
+        self.chamadas = 0
+
+    def _conexao(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.caminho, timeout=1, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS balde (chave TEXT PRIMARY KEY, tokens REAL, ultimo REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_balde_ultimo ON balde (ultimo)')
+            self.local.conn = conn
+        return conn
+
+    def consumir(self, chave, capacidade, janela):
+        taxa = capacidade / janela
+        agora = time.time()
+        self.chamadas += 1
+        try:
+            conn = self._conexao()
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.Error:
+            # Limitador indisponível (ex.: arquivo travado): a requisição segue normalmente
+            return True, capacidade, 0
+        try:
+            linha = conn.execute('SELECT tokens, ultimo FROM balde WHERE chave = ?', (chave,)).fetchone()
+            tokens, ultimo = linha if linha else (capacidade, agora)
+            tokens = min(capacidade, tokens + max(0, agora - ultimo) * taxa)
+            permitido = tokens >= 1
+            if permitido:
+                tokens -= 1
+            conn.execute('INSERT OR REPLACE INTO balde (chave, tokens, ultimo) VALUES (?, ?, ?)', (chave, tokens, agora))
+            if self.chamadas % self.LIMPAR_A_CADA == 0:
+                # Baldes ociosos há mais de uma hora já estariam cheios; acima de MAX_CHAVES,
+                # saem os usados há mais tempo, como no BaldeMemoria
+                conn.execute('DELETE FROM balde WHERE ultimo < ?', (agora - 3600,))
+                conn.execute('DELETE FROM balde WHERE ultimo <= (SELECT ultimo FROM balde ORDER BY ultimo DESC LIMIT 1 OFFSET ?)',
+                             (self.MAX_CHAVES,))
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            return True, capacidade, 0
+        return permitido, tokens, (1 - tokens) / taxa if not permitido else 0
+
+if app.config['RATE_LIMIT_BACKEND'] == 'sqlite':
+    os.makedirs(os.path.dirname(app.config['RATE_LIMIT_SQLITE']), exist_ok=True)
+    limitador = BaldeSQLite(app.config['RATE_LIMIT_SQLITE'])
+else:
+    limitador = BaldeMemoria()
+
+# Latência do banco medida em todas as queries (média móvel exponencial, em ms)
+latencia_db = {'media': 0.0, 'atualizado': 0.0}
+
+def _antes_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('inicio_query', []).append(time.perf_counter())
+
+def _depois_query(conn, cursor, statement, parameters, context, executemany):
+    inicio = conn.info['inicio_query'].pop()
+    duracao = (time.perf_counter() - inicio) * 1000
+    latencia_db['media'] = latencia_db['media'] * 0.9 + duracao * 0.1
+    latencia_db['atualizado'] = time.monotonic()
+
+def _erro_query(contexto):
+    # Query que falhou não passa pelo after_cursor_execute; descartamos o início dela
+    if contexto.connection is not None and contexto.connection.info.get('inicio_query'):
+        contexto.connection.info['inicio_query'].pop()
+
+with app.app_context():
+    event.listen(db.engine, 'before_cursor_execute', _antes_query)
+    event.listen(db.engine, 'after_cursor_execute', _depois_query)
+    event.listen(db.engine, 'handle_error', _erro_query)
+
+def banco_sobrecarregado():
+    # Medições antigas não contam: sem tráfego não há como saber se o banco ainda está lento
+    if time.monotonic() - latencia_db['atualizado'] > 5:
+        return False
+    return latencia_db['media'] > app.config['DB_LATENCIA_LIMITE_MS']
+
+# Slugs das barbearias cadastradas, para não criar um balde por slug inventado em /api/<slug>/...
+_slugs_conhecidos = {'slugs': frozenset(), 'atualizado': float('-inf')}
+_slugs_lock = threading.Lock()
+
+def barbearia_existe(slug):
+    if slug in _slugs_conhecidos['slugs']:
+        return True
+    # Slug desconhecido pode ser uma barbearia recém-criada: recarrega a lista, no máximo a cada 5 segundos
+    with _slugs_lock:
+        if time.monotonic() - _slugs_conhecidos['atualizado'] > 5:
+            with app.app_context():
+                slugs = frozenset(db.session.scalars(db.select(Configuracao.slug)))
+            _slugs_conhecidos.update(slugs=slugs, atualizado=time.monotonic())
+    return slug in _slugs_conhecidos['slugs']
+
+def verificar_admissao(endpoint, metodo, ip, sessao_id, slug):
+    """Retorna None se a requisição pode seguir, ou (status HTTP, segundos para tentar de novo)."""
+    limite = LIMITES_ROTAS.get(endpoint)
+    if not app.config['RATE_LIMIT_ATIVO'] or not limite or metodo not in limite[0]:
+        return None
+    _, capacidade, janela = limite
+
+    espera = 0
+    chaves = [] if endpoint in ROTAS_SEM_LIMITE_IP else [f'{endpoint}:ip:{ip}']
+    if sessao_id:
+        chaves.append(f'{endpoint}:sessao:{sessao_id}')
+    for chave in chaves:
+        permitido, _, aguardar = limitador.consumir(chave, capacidade, janela)
+        if not permitido:
+            espera = max(espera, aguardar)
+    # Requisição já recusada não gasta o balde da barbearia, senão um único cliente abusivo esgota o de todos
+    if espera:
+        return 429, espera
+
+    tokens_barbearia = None
+    if slug and barbearia_existe(slug):
+        capacidade_barbearia = capacidade * LIMITE_FATOR_BARBEARIA
+        permitido, tokens_barbearia, aguardar = limitador.consumir(f'{endpoint}:slug:{slug}', capacidade_barbearia, janela)
+        if not permitido:
+            return 429, aguardar
+
+    # Com o banco lento, descartamos primeiro as barbearias que estão em pico (balde abaixo da metade),
+    # assim as demais continuam sendo atendidas normalmente
+    if banco_sobrecarregado() and (tokens_barbearia is None or tokens_barbearia < capacidade * LIMITE_FATOR_BARBEARIA / 2):
+        return 503, 5
+    return None
+
+@app.before_request
+def controlar_admissao():
+    if request.endpoint not in LIMITES_ROTAS:
+        return None
+    sessao_id = session.get('_user_id') or session.get('cliente_telefone')
+    slug = (request.view_args or {}).get('slug')
+    resultado = verificar_admissao(request.endpoint, request.method, request.remote_addr, sessao_id, slug)
+    if resultado is None:
+        return None
+
+    status, espera = resultado
+    mensagem = 'Muitas requisições. Tente novamente em instantes.' if status == 429 else 'Sistema sobrecarregado. Tente novamente em instantes.'
+    if request.path.startswith('/api/'):
+        resposta = jsonify({'erro': mensagem})
+    else:
+        resposta = app.response_class(mensagem, mimetype='text/plain')
+    resposta.status_code = status
+    resposta.headers['Retry-After'] = str(max(1, math.ceil(espera)))
+    return resposta
+
+# --- PIPELINE DE ARQUIVOS ESTÁTICOS E LOGOS ---
+EXTENSOES_COMPRIMIVEIS = ('.css', '.js', '.svg', '.json', '.txt', '.html', '.map')
+LARGURAS_LOGO = (64, 128, 300, 600)
+LOGO_PADRAO = 'uploads/logo.png'
+LOGO_MAX_PIXELS = 4096 * 4096
+_impressoes_digitais = {}
+
+def impressao_digital(filename):
+    """Hash curto do conteúdo do arquivo estático, recalculado só quando o arquivo muda."""
+    caminho = safe_join(app.static_folder, filename)
+    if caminho is None or not os.path.isfile(caminho):
+        return None
+    mtime = os.path.getmtime(caminho)
+    cache = _impressoes_digitais.get(filename)
+    if cache and cache[0] == mtime:
+        return cache[1]
+    with open(caminho, 'rb') as f:
+        versao = hashlib.sha1(f.read()).hexdigest()[:12]
+    _impressoes_digitais[filename] = (mtime, versao)
+    return versao
+
+@app.template_global()
+def asset_url(filename):
+    versao = impressao_digital(filename)
+    if versao is None:
+        return url_for('static', filename=filename)
+    return url_for('static', filename=filename, v=versao)
+
+def _desatualizado(destino, mtime_origem):
+    return not os.path.isfile(destino) or os.path.getmtime(destino) < mtime_origem
+
+def gravar_atomico(destino, escrever):
+    """Grava num arquivo temporário da mesma pasta e troca de uma vez com os.replace(),
+    para que outro worker nunca sirva um arquivo pela metade."""
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    fd, temporario = tempfile.mkstemp(dir=os.path.dirname(destino), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            escrever(f)
+        os.chmod(temporario, 0o644) # mkstemp cria com 0600
+        os.replace(temporario, destino)
+    except BaseException:
+        os.unlink(temporario)
+        raise
+
+def precomprimir_estaticos():
+    # Gera .gz (e .br, se o pacote brotli estiver instalado) ao lado dos arquivos de texto
+    for raiz, _, arquivos in os.walk(app.static_folder):
+        for nome in arquivos:
+            if not nome.endswith(EXTENSOES_COMPRIMIVEIS):
+                continue
+            caminho = os.path.join(raiz, nome)
+            mtime = os.path.getmtime(caminho)
+            precisa_gz = _desatualizado(caminho + '.gz', mtime)
+            precisa_br = brotli is not None and _desatualizado(caminho + '.br', mtime)
+            if not (precisa_gz or precisa_br):
+                continue
+            with open(caminho, 'rb') as f:
+                conteudo = f.read()
+            if precisa_gz:
+                comprimido = gzip.compress(conteudo, compresslevel=9, mtime=0)
+                gravar_atomico(caminho + '.gz', lambda f: f.write(comprimido))
+            if precisa_br:
+                comprimido_br = brotli.compress(conteudo)
+                gravar_atomico(caminho + '.br', lambda f: f.write(comprimido_br))
+
+def _variante_logo(original, largura, formato):
+    # uploads/logos/slug.png -> uploads/variantes/logos/slug-64.webp
+    relativo = os.path.splitext(os.path.relpath(original, 'uploads'))[0]
+    return f'uploads/variantes/{relativo}-{largura}.{formato}'
+
+def gerar_variantes_logo(original):
+    """Cria versões reduzidas em WebP e PNG do logo (caminho relativo à pasta static)."""
+    with Image.open(os.path.join(app.static_folder, original)) as imagem:
+        imagem = imagem.convert('RGBA')
+    for largura in LARGURAS_LOGO:
+        if largura < imagem.width:
+            altura = max(1, round(imagem.height * largura / imagem.width))
+            reduzida = imagem.resize((largura, altura), Image.LANCZOS)
+        else:
+            reduzida = imagem
+        destino = os.path.join(app.static_folder, _variante_logo(original, largura, 'webp'))
+        gravar_atomico(destino, lambda f: reduzida.save(f, 'WEBP', quality=85, method=6))
+        gravar_atomico(destino[:-len('webp')] + 'png', lambda f: reduzida.save(f, 'PNG', optimize=True))
+
+def _logo_barbearia(config):
+    return f'uploads/logos/{secure_filename(config.slug)}.png'
+
+@app.template_global()
+def tem_logo(config):
+    # Nos templates sem barbearia, "config" pode ser indefinido ou o próprio app.config
+    if not isinstance(config, Configuracao):
+        return False
+    return os.path.isfile(os.path.join(app.static_folder, _logo_barbearia(config)))
+
+@app.template_global()
+def logo_url(config=None, largura=128, formato='webp'):
+    original = _logo_barbearia(config) if tem_logo(config) else LOGO_PADRAO
+    variante = _variante_logo(original, largura, formato)
+    if os.path.isfile(os.path.join(app.static_folder, variante)):
+        return asset_url(variante)
+    return asset_url(original)
+
+def salvar_logo(config, arquivo):
+    # Abrir com o Pillow já valida que o upload é realmente uma imagem; o open só lê o cabeçalho,
+    # então recusamos imagens enormes (poucos MB comprimidos, centenas de MB decodificadas) antes de decodificar
+    with Image.open(arquivo.stream) as imagem:
+        if imagem.width * imagem.height > LOGO_MAX_PIXELS:
+            raise Image.DecompressionBombError(f'Imagem com {imagem.width}x{imagem.height} pixels.')
+        if imagem.mode in ('1', 'P'):
+            # Paleta só é redimensionada com NEAREST; convertida antes para reduzir com qualidade
+            imagem = imagem.convert('RGBA')
+        # Reduz antes de converter (JPEG já é decodificado em escala menor), sem expandir a imagem inteira em RGBA
+        imagem.thumbnail((1024, 1024))
+        imagem = imagem.convert('RGBA')
+    original = _logo_barbearia(config)
+    gravar_atomico(os.path.join(app.static_folder, original), lambda f: imagem.save(f, 'PNG', optimize=True))
+    gerar_variantes_logo(original)
+
+def remover_logo(config):
+    original = _logo_barbearia(config)
+    caminhos = [original] + [_variante_logo(original, largura, formato)
+                             for largura in LARGURAS_LOGO for formato in ('webp', 'png')]
+    for caminho in caminhos:
+        try:
+            os.remove(os.path.join(app.static_folder, caminho))
+        except FileNotFoundError:
+            pass
+
+def preparar_assets():
+    precomprimir_estaticos()
+    logos = [LOGO_PADRAO]
+    pasta_logos = os.path.join(app.static_folder, 'uploads', 'logos')
+    if os.path.isdir(pasta_logos):
+        logos += [f'uploads/logos/{nome}' for nome in os.listdir(pasta_logos) if nome.endswith('.png')]
+    for original in logos:
+        caminho = os.path.join(app.static_folder, original)
+        variante = os.path.join(app.static_folder, _variante_logo(original, LARGURAS_LOGO[-1], 'png'))
+        if os.path.isfile(caminho) and _desatualizado(variante, os.path.getmtime(caminho)):
+            gerar_variantes_logo(original)
+
+def servir_estatico(filename):
+    resposta = None
+    if filename.endswith(EXTENSOES_COMPRIMIVEIS):
+        for codificacao, sufixo in (('br', '.br'), ('gzip', '.gz')):
+            comprimido = safe_join(app.static_folder, filename + sufixo)
+            if request.accept_encodings[codificacao] and comprimido and os.path.isfile(comprimido):
+                resposta = send_from_directory(app.static_folder, filename + sufixo,
+                                               mimetype=mimetypes.guess_type(filename)[0])
+                resposta.headers['Content-Encoding'] = codificacao
+                break
+    if resposta is None:
+        resposta = send_from_directory(app.static_folder, filename)
+    if filename.endswith(EXTENSOES_COMPRIMIVEIS):
+        resposta.vary.add('Accept-Encoding')
+
+    # URLs com impressão digital nunca mudam de conteúdo: cache "eterno" no navegador e no CDN
+    versao = request.args.get('v')
+    if versao and versao == impressao_digital(filename):
+        resposta.cache_control.no_cache = None
+        resposta.cache_control.public = True
+        resposta.cache_control.max_age = app.config['ASSETS_CACHE_SEGUNDOS']
+        resposta.cache_control.immutable = True
+    return resposta
+
+app.view_functions['static'] = servir_estatico
+
+preparar_assets()
+
 # --- ROTAS GLOBAIS ---
 @app.route('/login_master', methods=['GET', 'POST'])
 def login_global():
@@ -201,30 +783,80 @@ def excluir_barbearia(id):
     barbearia = Configuracao.query.get_or_404(id)
     db.session.delete(barbearia)
     db.session.commit()
+    # Sem isso uma nova barbearia com o mesmo slug herdaria o logo antigo
+    remover_logo(barbearia)
     flash(f'Barbearia {barbearia.nome_barbearia} excluída com sucesso.', 'success')
     return redirect(url_for('index_root'))
 
+# --- CONSULTAS DA API PÚBLICA ---
+# Montadas como select() para serem executadas tanto pelo Flask (db.session) quanto pelo modo assíncrono (asgi.py)
+def consulta_horarios_ocupados(barbearia_id, data_selecionada):
+    return db.select(Agendamento.data_hora).where(
+        Agendamento.barbearia_id == barbearia_id,
+        db.func.date(Agendamento.data_hora) == data_selecionada,
+        Agendamento.status.in_(['Pendente', 'Confirmado', 'Concluído'])
+    )
+
+def consulta_cliente_por_telefone(barbearia_id, telefone):
+    return db.select(Cliente.id).where(Cliente.telefone == telefone, Cliente.barbearia_id == barbearia_id)
+
+def consulta_lembrete(barbearia_id, cliente_id, minutos):
+    agora = datetime.now()
+    return db.select(Agendamento.id, Agendamento.data_hora).where(
+        Agendamento.cliente_id == cliente_id,
+        Agendamento.barbearia_id == barbearia_id,
+        Agendamento.status.in_(['Pendente', 'Confirmado']),
+        Agendamento.data_hora > agora,
+        Agendamento.data_hora <= agora + timedelta(minutes=minutos)
+    ).limit(1)
+
+def consulta_faltam_fila(barbearia_id, posicao):
+    # Pessoas na frente (status 'aguardando' e posição menor)
+    return db.select(db.func.count(Fila.id)).where(
+        Fila.barbearia_id == barbearia_id,
+        Fila.status == 'aguardando',
+        Fila.posicao < posicao
+    )
+
+def parse_data(data_str):
+    try:
+        return datetime.strptime(data_str, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return None
+
+def resposta_lembrete(agendamento):
+    if agendamento is None:
+        return {'notificar': False}
+    return {
+        'notificar': True,
+        'mensagem': f"Lembrete: Seu corte de cabelo está agendado para as {agendamento.data_hora.strftime('%H:%M')}!",
+        'id': agendamento.id
+    }
+
+def resposta_fila_status(item, faltam):
+    return {
+        'status': item.status,
+        'posicao': item.posicao,
+        'faltam': faltam,
+        'tempo_estimado': faltam * 30 # Estimativa simples de 30 min por pessoa
+    }
+
+def resposta_agendamento_status(agendamento):
+    return {
+        'status': agendamento.status,
+        'data_hora': agendamento.data_hora.strftime('%d/%m/%Y %H:%M')
+    }
+
 # --- API PARA VERIFICAR HORÁRIOS OCUPADOS ---
 @app.route('/api/<slug>/horarios_ocupados')
 def horarios_ocupados(slug):
     config = Configuracao.query.filter_by(slug=slug).first_or_404()
-    data_str = request.args.get('data')
-    if not data_str:
-        return jsonify([])
-    
-    try:
-        data_selecionada = datetime.strptime(data_str, '%Y-%m-%d').date()
-    except:
+    data_selecionada = parse_data(request.args.get('data'))
+    if not data_selecionada:
         return jsonify([])
 
-    agendamentos = Agendamento.query.filter(
-        Agendamento.barbearia_id == config.id,
-        db.func.date(Agendamento.data_hora) == data_selecionada,
-        Agendamento.status.in_(['Pendente', 'Confirmado', 'Concluído'])
-    ).all()
-    
-    horarios = [a.data_hora.strftime('%H:%M') for a in agendamentos]
-    return jsonify(horarios)
+    horarios = db.session.execute(consulta_horarios_ocupados(config.id, data_selecionada)).scalars()
+    return jsonify([h.strftime('%H:%M') for h in horarios])
 
 @app.route('/api/<slug>/verificar_notificacoes')
 def verificar_notificacoes(slug):
@@ -237,28 +869,11 @@ def verificar_notificacoes(slug):
         # Tenta pegar o telefone da sessão para clientes não logados
         telefone = session.get('cliente_telefone')
         if telefone:
-            cliente = Cliente.query.filter_by(telefone=telefone, barbearia_id=config.id).first()
-            if cliente:
-                cliente_id = cliente.id
+            cliente_id = db.session.execute(consulta_cliente_por_telefone(config.id, telefone)).scalar()
 
     if cliente_id:
-        agora = datetime.now()
-        limite = agora + timedelta(minutes=config.notificacao_minutos)
-        
-        agendamento = Agendamento.query.filter(
-            Agendamento.cliente_id == cliente_id,
-            Agendamento.barbearia_id == config.id,
-            Agendamento.status.in_(['Pendente', 'Confirmado']),
-            Agendamento.data_hora > agora,
-            Agendamento.data_hora <= limite
-        ).first()
-        
-        if agendamento:
-            return jsonify({
-                'notificar': True,
-                'mensagem': f"Lembrete: Seu corte de cabelo está agendado para as {agendamento.data_hora.strftime('%H:%M')}!",
-                'id': agendamento.id
-            })
+        agendamento = db.session.execute(consulta_lembrete(config.id, cliente_id, config.notificacao_minutos)).first()
+        return jsonify(resposta_lembrete(agendamento))
             
     return jsonify({'notificar': False})
 
@@ -386,14 +1001,8 @@ def acompanhar_fila(slug, item_id):
     config = Configuracao.query.filter_by(slug=slug).first_or_404()
     item = Fila.query.get_or_404(item_id)
     
-    # Pessoas na frente (status 'aguardando' e posição menor)
-    faltam = Fila.query.filter(
-        Fila.barbearia_id == config.id,
-        Fila.status == 'aguardando',
-        Fila.posicao < item.posicao
-    ).count()
-    
-    tempo_estimado = faltam * 30 # Estimativa simples de 30 min por pessoa
+    faltam = db.session.execute(consulta_faltam_fila(config.id, item.posicao)).scalar()
+    tempo_estimado = resposta_fila_status(item, faltam)['tempo_estimado']
     
     return render_template('fila_acompanhar.html', item=item, faltam=faltam, tempo_estimado=tempo_estimado, config=config)
 
@@ -402,18 +1011,66 @@ def api_fila_status(slug, item_id):
     config = Configuracao.query.filter_by(slug=slug).first_or_404()
     item = Fila.query.get_or_404(item_id)
     
-    faltam = Fila.query.filter(
-        Fila.barbearia_id == config.id,
-        Fila.status == 'aguardando',
-        Fila.posicao < item.posicao
-    ).count()
-    
-    return jsonify({
-        'status': item.status,
-        'posicao': item.posicao,
-        'faltam': faltam,
-        'tempo_estimado': faltam * 30
-    })
+    faltam = db.session.execute(consulta_faltam_fila(config.id, item.posicao)).scalar()
+    return jsonify(resposta_fila_status(item, faltam))
+
+# --- FEED INCREMENTAL DA FILA (TVs e tablets) ---
+STATUS_ATIVOS_FILA = ('aguardando', 'chamado', 'atendendo')
+FILA_FEED_MAX_DELTA = 200
+
+def consulta_fila_feed(barbearia_id, desde=None):
+    """Itens ativos (desde=None) ou itens alterados depois de `desde`."""
+    consulta = db.select(
+        Fila.id, Fila.posicao, Fila.cliente_nome, Fila.status, Fila.seq, Fila.seq_inicial,
+        Servico.nome.label('servico'), Usuario.username.label('barbeiro')
+    ).join(Servico, Fila.servico_id == Servico.id).outerjoin(Usuario, Fila.barbeiro_id == Usuario.id).where(
+        Fila.barbearia_id == barbearia_id
+    )
+    if desde is None:
+        return consulta.where(Fila.status.in_(STATUS_ATIVOS_FILA)).order_by(Fila.posicao)
+    # Um item a mais que o limite indica que é melhor mandar a fila completa
+    return consulta.where(Fila.seq > desde).order_by(Fila.seq).limit(FILA_FEED_MAX_DELTA + 1)
+
+def montar_fila_feed(seq_atual, desde, linhas):
+    def item(linha):
+        return {'id': linha.id, 'posicao': linha.posicao, 'nome': linha.cliente_nome, 'status': linha.status,
+                'servico': linha.servico, 'barbeiro': linha.barbeiro}
+
+    if desde is None:
+        return {'seq': seq_atual, 'completo': True, 'itens': [item(l) for l in linhas]}
+
+    feed = {'seq': seq_atual, 'completo': False, 'inseridos': [], 'atualizados': [], 'removidos': []}
+    for linha in linhas:
+        if linha.status in STATUS_ATIVOS_FILA:
+            feed['inseridos' if linha.seq_inicial > desde else 'atualizados'].append(item(linha))
+        else:
+            # Ids que o cliente não conhece são simplesmente ignorados por ele
+            feed['removidos'].append(linha.id)
+    return feed
+
+def normalizar_since(desde, seq_atual):
+    # Sequência desconhecida (cliente novo ou à frente do servidor) -> fila completa
+    if desde is None or desde < 0 or desde > seq_atual:
+        return None
+    return desde
+
+@app.route('/api/<slug>/fila/feed')
+def api_fila_feed(slug):
+    config = Configuracao.query.filter_by(slug=slug).first_or_404()
+    desde = normalizar_since(request.args.get('since', type=int), config.fila_seq)
+    if desde == config.fila_seq:
+        return jsonify({'seq': desde, 'completo': False, 'inseridos': [], 'atualizados': [], 'removidos': []})
+
+    linhas = db.session.execute(consulta_fila_feed(config.id, desde)).all()
+    if desde is not None and len(linhas) > FILA_FEED_MAX_DELTA:
+        desde = None
+        linhas = db.session.execute(consulta_fila_feed(config.id)).all()
+    return jsonify(montar_fila_feed(config.fila_seq, desde, linhas))
+
+@app.route('/<slug>/fila/tv')
+def fila_tv(slug):
+    config = Configuracao.query.filter_by(slug=slug).first_or_404()
+    return render_template('fila_tv.html', config=config, long_poll=app.config['FILA_LONG_POLL'])
 
 @app.route('/<slug>/admin/fila')
 @login_required
@@ -427,7 +1084,7 @@ def fila_painel(slug):
         Fila.status.in_(['aguardando', 'chamado', 'atendendo'])
     ).order_by(Fila.posicao).all()
     
-    return render_template('fila_painel.html', fila=fila, config=config)
+    return render_template('fila_painel.html', fila=fila, config=config, seq=config.fila_seq)
 
 @app.route('/admin/fila/chamar/<int:id>')
 @login_required
@@ -500,10 +1157,7 @@ def agendamento_confirmacao(slug, agendamento_id):
 @app.route('/api/<slug>/agendamento/status/<int:agendamento_id>')
 def api_agendamento_status(slug, agendamento_id):
     agendamento = Agendamento.query.get_or_404(agendamento_id)
-    return jsonify({
-        'status': agendamento.status,
-        'data_hora': agendamento.data_hora.strftime('%d/%m/%Y %H:%M')
-    })
+    return jsonify(resposta_agendamento_status(agendamento))
 
 @app.route('/<slug>/agendar', methods=['GET', 'POST'])
 def agendar_cliente(slug):
@@ -581,7 +1235,8 @@ def listar_agendamentos(slug):
     if not getattr(current_user, 'is_admin', False) or (not current_user.is_superadmin and current_user.barbearia_id != config.id):
         return redirect(url_for('home_cliente', slug=slug))
     agendamentos = Agendamento.query.filter_by(barbearia_id=config.id).order_by(Agendamento.data_hora.desc()).all()
-    return render_template('agendamentos.html', agendamentos=agendamentos, config=config)
+    servicos = Servico.query.filter_by(barbearia_id=config.id).all()
+    return render_template('agendamentos.html', agendamentos=agendamentos, servicos=servicos, config=config)
 
 @app.route('/<slug>/admin/agendamento/novo', methods=['GET', 'POST'])
 @login_required
@@ -597,6 +1252,30 @@ def novo_agendamento(slug):
         if barbeiro_id == "": barbeiro_id = None
         data_hora_str = request.form.get('data_hora')
         data_hora = datetime.strptime(data_hora_str, '%Y-%m-%dT%H:%M')
+
+        frequencia = request.form.get('frequencia')
+        if frequencia in FREQUENCIAS:
+            data_fim = parse_data(request.form.get('data_fim'))
+            quantidade = request.form.get('quantidade', type=int)
+            if not data_fim and not quantidade:
+                flash('Informe a data final ou a quantidade de repetições.', 'danger')
+                return redirect(url_for('novo_agendamento', slug=slug))
+
+            try:
+                criados, conflitos = criar_serie(config, cliente_id, servico_id, barbeiro_id, data_hora, frequencia,
+                                                 data_fim, quantidade, 'pular_conflitos' in request.form)
+            except ValueError as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('novo_agendamento', slug=slug))
+            horarios = ', '.join(c.strftime('%d/%m/%Y %H:%M') for c in conflitos)
+            if not criados:
+                flash(f'Horários já ocupados: {horarios}' if conflitos else 'Nenhuma data gerada para a série.', 'danger')
+                return redirect(url_for('novo_agendamento', slug=slug))
+            db.session.commit()
+            flash(f'{criados} agendamento(s) recorrentes criados!', 'success')
+            if conflitos:
+                flash(f'Horários ocupados ignorados: {horarios}', 'warning')
+            return redirect(url_for('index', slug=slug))
         
         novo = Agendamento(cliente_id=cliente_id, servico_id=servico_id, barbeiro_id=barbeiro_id, data_hora=data_hora, status='Confirmado', barbearia_id=config.id)
         db.session.add(novo)
@@ -608,6 +1287,114 @@ def novo_agendamento(slug):
     servicos = Servico.query.filter_by(barbearia_id=config.id).all()
     return render_template('agendamento_form.html', clientes=clientes, servicos=servicos, config=config)
 
+# --- AGENDAMENTOS RECORRENTES ---
+FREQUENCIAS = {'semanal': 7, 'quinzenal': 14, 'mensal': None}
+MAX_OCORRENCIAS = 52
+STATUS_OCUPADOS = ['Pendente', 'Confirmado', 'Concluído']
+
+def somar_meses(data, meses):
+    # Dia 31 em meses menores vira o último dia do mês
+    mes = data.month - 1 + meses
+    ano = data.year + mes // 12
+    mes = mes % 12 + 1
+    return data.replace(year=ano, month=mes, day=min(data.day, calendar.monthrange(ano, mes)[1]))
+
+def gerar_ocorrencias(inicio, frequencia, data_fim=None, quantidade=None):
+    """Datas da série. Levanta ValueError se ela passar de MAX_OCORRENCIAS, em vez de cortá-la em silêncio."""
+    if quantidade and quantidade > MAX_OCORRENCIAS:
+        raise ValueError(f'A série pode ter no máximo {MAX_OCORRENCIAS} agendamentos.')
+    # Com só a data final, geramos um a mais que o máximo para saber se ela cabe
+    limite = quantidade or MAX_OCORRENCIAS + 1
+    ocorrencias = []
+    while len(ocorrencias) < limite:
+        n = len(ocorrencias)
+        # Sempre calculado a partir do início, para o dia do mês não "escorregar"
+        data = somar_meses(inicio, n) if FREQUENCIAS[frequencia] is None else inicio + timedelta(days=FREQUENCIAS[frequencia] * n)
+        if data_fim and data.date() > data_fim:
+            break
+        ocorrencias.append(data)
+    if len(ocorrencias) > MAX_OCORRENCIAS:
+        raise ValueError(f'A série pode ter no máximo {MAX_OCORRENCIAS} agendamentos. Escolha uma data final mais próxima.')
+    return ocorrencias
+
+def conflitos_serie(barbearia_id, ocorrencias):
+    # Uma única consulta cobre a série inteira e devolve no máximo len(ocorrencias) linhas
+    ocupados = db.session.execute(
+        db.select(Agendamento.data_hora).where(
+            Agendamento.barbearia_id == barbearia_id,
+            Agendamento.status.in_(STATUS_OCUPADOS),
+            Agendamento.data_hora >= ocorrencias[0],
+            Agendamento.data_hora <= ocorrencias[-1],
+            Agendamento.data_hora.in_(ocorrencias)
+        )
+    ).scalars()
+    return sorted(set(ocorrencias) & set(ocupados))
+
+def criar_serie(config, cliente_id, servico_id, barbeiro_id, inicio, frequencia, data_fim, quantidade, pular_conflitos):
+    """Cria a regra e todas as ocorrências num único INSERT em lote. Retorna (quantidade criada, conflitos)."""
+    ocorrencias = gerar_ocorrencias(inicio, frequencia, data_fim, quantidade)
+    if not ocorrencias:
+        return 0, []
+    conflitos = conflitos_serie(config.id, ocorrencias)
+    if conflitos and not pular_conflitos:
+        return 0, conflitos
+    ocupados = set(conflitos)
+    livres = [data for data in ocorrencias if data not in ocupados]
+    if not livres:
+        return 0, conflitos
+
+    recorrencia = Recorrencia(barbearia_id=config.id, cliente_id=cliente_id, frequencia=frequencia,
+                              data_inicio=inicio, data_fim=data_fim, quantidade=quantidade)
+    db.session.add(recorrencia)
+    db.session.flush()
+    db.session.execute(db.insert(Agendamento), [
+        dict(cliente_id=cliente_id, servico_id=servico_id, barbeiro_id=barbeiro_id, data_hora=data,
+             status='Confirmado', barbearia_id=config.id, recorrencia_id=recorrencia.id)
+        for data in livres
+    ])
+    return len(livres), conflitos
+
+def ocorrencias_futuras(config, recorrencia_id):
+    return db.and_(
+        Agendamento.recorrencia_id == recorrencia_id,
+        Agendamento.barbearia_id == config.id,
+        Agendamento.status.in_(['Pendente', 'Confirmado']),
+        Agendamento.data_hora >= datetime.now()
+    )
+
+@app.route('/<slug>/admin/recorrencia/alterar/<int:id>', methods=['POST'])
+@login_required
+def alterar_recorrencia(slug, id):
+    config = Configuracao.query.filter_by(slug=slug).first_or_404()
+    if not getattr(current_user, 'is_admin', False) or (not current_user.is_superadmin and current_user.barbearia_id != config.id):
+        return redirect(url_for('home_cliente', slug=slug))
+    Recorrencia.query.filter_by(id=id, barbearia_id=config.id).first_or_404()
+
+    barbeiro_id = request.form.get('barbeiro_id')
+    if barbeiro_id == "": barbeiro_id = None
+    alterados = db.session.execute(
+        db.update(Agendamento).where(ocorrencias_futuras(config, id))
+        .values(servico_id=request.form.get('servico_id'), barbeiro_id=barbeiro_id)
+    ).rowcount
+    db.session.commit()
+    flash(f'{alterados} agendamento(s) futuros da série atualizados.', 'success')
+    return redirect(request.referrer or url_for('listar_agendamentos', slug=slug))
+
+@app.route('/<slug>/admin/recorrencia/cancelar/<int:id>')
+@login_required
+def cancelar_recorrencia(slug, id):
+    config = Configuracao.query.filter_by(slug=slug).first_or_404()
+    if not getattr(current_user, 'is_admin', False) or (not current_user.is_superadmin and current_user.barbearia_id != config.id):
+        return redirect(url_for('home_cliente', slug=slug))
+    Recorrencia.query.filter_by(id=id, barbearia_id=config.id).first_or_404()
+
+    cancelados = db.session.execute(
+        db.update(Agendamento).where(ocorrencias_futuras(config, id)).values(status='Cancelado')
+    ).rowcount
+    db.session.commit()
+    flash(f'{cancelados} agendamento(s) futuros da série cancelados.', 'info')
+    return redirect(request.referrer or url_for('listar_agendamentos', slug=slug))
+
 @app.route('/<slug>/admin/agendamento/alterar/<int:id>', methods=['POST'])
 @login_required
 def alterar_data_agendamento(slug, id):
@@ -638,17 +1425,14 @@ def confirmar_agendamento(slug, id):
 def concluir_agendamento(slug, id):
     config = Configuracao.query.filter_by(slug=slug).first_or_404()
     agendamento = Agendamento.query.filter_by(id=id, barbearia_id=config.id).first_or_404()
-    if agendamento.status != 'Concluído':
-        agendamento.status = 'Concluído'
-        cliente = Cliente.query.get(agendamento.cliente_id)
-        cliente.cortes_realizados += 1
-        
-        if config.fidelidade_ativa:
-            cliente.fidelidade_pontos += 1
-            if cliente.fidelidade_pontos >= config.fidelidade_cortes_necessarios:
-                 cliente.fidelidade_pontos = 0
-                 flash(f'Parabéns! {cliente.nome} ganhou um corte grátis!', 'info')
-        
+    # UPDATE condicional: duas conclusões simultâneas não creditam o mesmo corte duas vezes
+    concluido = db.session.execute(
+        db.update(Agendamento).where(Agendamento.id == agendamento.id, Agendamento.status != 'Concluído')
+        .values(status='Concluído')
+    ).rowcount
+    if concluido:
+        if registrar_corte(config, agendamento.cliente_id, agendamento.id):
+            flash(f'Parabéns! {agendamento.cliente.nome} ganhou um corte grátis!', 'info')
         db.session.commit()
         flash('Atendimento concluído!', 'success')
     return redirect(request.referrer or url_for('index', slug=slug))
@@ -709,9 +1493,21 @@ def configuracoes(slug):
         config.horario_fechamento = request.form.get('horario_fechamento')
         config.intervalo_minutos = int(request.form.get('intervalo_minutos', 30))
         config.fidelidade_ativa = 'fidelidade_ativa' in request.form
+        cortes_anterior = config.fidelidade_cortes_necessarios
         config.fidelidade_cortes_necessarios = int(request.form.get('fidelidade_cortes_necessarios', 10))
+        if config.fidelidade_ativa and config.fidelidade_cortes_necessarios < cortes_anterior:
+            premiados = reavaliar_fidelidade(config)
+            if premiados:
+                flash(f'{premiados} cliente(s) atingiram o novo limite e ganharam um corte grátis.', 'info')
         config.notificacao_minutos = int(request.form.get('notificacao_minutos', 15))
         db.session.commit()
+        logo = request.files.get('logo')
+        if logo and logo.filename:
+            try:
+                salvar_logo(config, logo)
+            except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+                flash('Configurações salvas, mas não foi possível processar o logo enviado. Envie uma imagem PNG, JPG ou WebP.', 'warning')
+                return redirect(url_for('configuracoes', slug=slug))
         flash('Configurações atualizadas!', 'success')
         return redirect(url_for('configuracoes', slug=slug))
     return render_template('configuracoes.html', config=config, servicos=servicos)
@@ -0,0 +1,287 @@
+"""Modo de execução assíncrono (ASGI).
+
+As rotas de consulta em /api/<slug>/... são atendidas aqui com acesso assíncrono ao banco,
+de modo que milhares de celulares e TVs esperando (inclusive em long-poll) não prendem
+um worker cada. Todas as outras rotas continuam sendo do Flask (WSGI), executadas num
+pool de threads.
+
+    uvicorn --app-dir barbearia_system asgi:app --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from sqlalchemy.engine import make_url
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import MethodNotAllowed, NotFound
+from werkzeug.http import parse_cookie
+
+from app import (
+    app as flask_app, db, Configuracao, Fila, Agendamento, BaldeSQLite, limitador, verificar_admissao,
+    _antes_query, _depois_query, _erro_query, consulta_horarios_ocupados, consulta_cliente_por_telefone,
+    consulta_lembrete, consulta_faltam_fila, consulta_fila_feed, montar_fila_feed, normalizar_since,
+    parse_data, resposta_lembrete, resposta_fila_status, resposta_agendamento_status, FILA_FEED_MAX_DELTA
+)
+
+# Drivers assíncronos equivalentes aos usados pelo Flask-SQLAlchemy
+DRIVERS_ASSINCRONOS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+LONG_POLL_MAX_SEGUNDOS = 25
+
+def _url_assincrona():
+    if os.environ.get('ASYNC_DATABASE_URI'):
+        return os.environ['ASYNC_DATABASE_URI']
+    url = make_url(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+    return url.set(drivername=DRIVERS_ASSINCRONOS.get(url.drivername, url.drivername))
+
+# Neste modo o feed da fila atende ?wait=; as páginas (fila_tv) passam a usar long-poll
+flask_app.config['FILA_LONG_POLL'] = True
+
+engine = create_async_engine(_url_assincrona())
+# As queries assíncronas também alimentam a medição de latência usada no descarte de carga
+event.listen(engine.sync_engine, 'before_cursor_execute', _antes_query)
+event.listen(engine.sync_engine, 'after_cursor_execute', _depois_query)
+event.listen(engine.sync_engine, 'handle_error', _erro_query)
+
+async def buscar_config(slug):
+    async with engine.connect() as conn:
+        resultado = await conn.execute(
+            db.select(Configuracao.id, Configuracao.fila_seq, Configuracao.notificacao_minutos)
+            .where(Configuracao.slug == slug)
+        )
+        return resultado.first()
+
+class _EstadoVigia:
+    def __init__(self, seq):
+        self.evento = asyncio.Event()
+        self.ultimo = seq
+        self.esperando = 0
+        self.tarefa = None # referência mantida aqui para a tarefa não ser coletada
+
+    def acordar(self, seq):
+        self.ultimo = seq
+        self.evento.set()
+        self.evento = asyncio.Event()
+
+class VigiaFila:
+    """Um único laço por barbearia consulta a sequência da fila; todos os long-polls esperam no mesmo evento."""
+
+    def __init__(self):
+        self.estados = {}
+
+    async def aguardar(self, barbearia_id, seq, timeout):
+        estado = self.estados.get(barbearia_id)
+        if estado is None:
+            estado = self.estados[barbearia_id] = _EstadoVigia(seq)
+            estado.tarefa = asyncio.create_task(self._vigiar(barbearia_id, estado))
+        elif seq < estado.ultimo:
+            return
+        elif seq > estado.ultimo:
+            # Este cliente já viu uma mudança que o laço ainda não percebeu: acorda quem está atrasado
+            estado.acordar(seq)
+
+        evento = estado.evento
+        estado.esperando += 1
+        try:
+            await asyncio.wait_for(evento.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            estado.esperando -= 1
+
+    async def _vigiar(self, barbearia_id, estado):
+        try:
+            while True:
+                await asyncio.sleep(1)
+                if not estado.esperando:
+                    break
+                try:
+                    async with engine.connect() as conn:
+                        seq = await conn.scalar(db.select(Configuracao.fila_seq).where(Configuracao.id == barbearia_id))
+                except SQLAlchemyError:
+                    continue # tenta de novo no próximo ciclo; quem espera volta no próprio timeout
+                if seq != estado.ultimo:
+                    estado.acordar(seq)
+        finally:
+            if self.estados.get(barbearia_id) is estado:
+                del self.estados[barbearia_id]
+            # Quem ainda estiver esperando volta e consulta o banco por conta própria
+            estado.evento.set()
+
+vigia_fila = VigiaFila()
+
+class Requisicao:
+    def __init__(self, scope, endpoint, view_args):
+        self.scope = scope
+        self.endpoint = endpoint
+        self.view_args = view_args
+        self.args = MultiDict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+        self.sessao = self._ler_sessao(self.headers.get('cookie', ''))
+
+    @staticmethod
+    def _ler_sessao(cookie):
+        # Mesmo cookie assinado da sessão do Flask (e do Flask-Login)
+        valor = parse_cookie(cookie).get(flask_app.config['SESSION_COOKIE_NAME'])
+        serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        if not valor or serializer is None:
+            return {}
+        try:
+            return serializer.loads(valor, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+        except Exception:
+            return {}
+
+    @property
+    def ip(self):
+        # Mesma regra do ProxyFix no modo síncrono: com N proxies confiáveis (ex.: o roteador do Heroku),
+        # o IP do cliente é o N-ésimo a partir do fim do X-Forwarded-For
+        proxies = flask_app.config['PROXIES_CONFIAVEIS']
+        encaminhado = [ip.strip() for ip in self.headers.get('x-forwarded-for', '').split(',') if ip.strip()]
+        if proxies and len(encaminhado) >= proxies:
+            return encaminhado[-proxies]
+        cliente = self.scope.get('client')
+        return cliente[0] if cliente else None
+
+    def cliente_logado(self):
+        user_id = str(self.sessao.get('_user_id', ''))
+        return int(user_id[2:]) if user_id.startswith('c_') else None
+
+# --- ROTAS ASSÍNCRONAS (mesmos endpoints e respostas das rotas do Flask) ---
+async def horarios_ocupados(req, config):
+    data_selecionada = parse_data(req.args.get('data'))
+    if not data_selecionada:
+        return 200, []
+    async with engine.connect() as conn:
+        horarios = (await conn.execute(consulta_horarios_ocupados(config.id, data_selecionada))).scalars()
+        return 200, [h.strftime('%H:%M') for h in horarios]
+
+async def verificar_notificacoes(req, config):
+    async with engine.connect() as conn:
+        cliente_id = req.cliente_logado()
+        telefone = req.sessao.get('cliente_telefone')
+        if not cliente_id and telefone:
+            cliente_id = await conn.scalar(consulta_cliente_por_telefone(config.id, telefone))
+        if not cliente_id:
+            return 200, {'notificar': False}
+        agendamento = (await conn.execute(consulta_lembrete(config.id, cliente_id, config.notificacao_minutos))).first()
+        return 200, resposta_lembrete(agendamento)
+
+async def api_fila_status(req, config):
+    async with engine.connect() as conn:
+        item = (await conn.execute(
+            db.select(Fila.status, Fila.posicao).where(Fila.id == req.view_args['item_id'])
+        )).first()
+        if item is None:
+            return 404, {'erro': 'Item não encontrado.'}
+        faltam = await conn.scalar(consulta_faltam_fila(config.id, item.posicao))
+        return 200, resposta_fila_status(item, faltam)
+
+async def api_agendamento_status(req, config):
+    async with engine.connect() as conn:
+        agendamento = (await conn.execute(
+            db.select(Agendamento.status, Agendamento.data_hora).where(Agendamento.id == req.view_args['agendamento_id'])
+        )).first()
+    if agendamento is None:
+        return 404, {'erro': 'Agendamento não encontrado.'}
+    return 200, resposta_agendamento_status(agendamento)
+
+async def api_fila_feed(req, config):
+    desde = normalizar_since(req.args.get('since', type=int), config.fila_seq)
+    seq_atual = config.fila_seq
+    espera = min(req.args.get('wait', default=0, type=int), LONG_POLL_MAX_SEGUNDOS)
+    if desde == seq_atual and espera > 0:
+        # Long-poll: nenhuma conexão com o banco fica presa enquanto o cliente espera
+        await vigia_fila.aguardar(config.id, desde, espera)
+        async with engine.connect() as conn:
+            seq_atual = await conn.scalar(db.select(Configuracao.fila_seq).where(Configuracao.id == config.id))
+    if desde == seq_atual:
+        return 200, {'seq': desde, 'completo': False, 'inseridos': [], 'atualizados': [], 'removidos': []}
+
+    async with engine.connect() as conn:
+        linhas = (await conn.execute(consulta_fila_feed(config.id, desde))).all()
+        if desde is not None and len(linhas) > FILA_FEED_MAX_DELTA:
+            desde = None
+            linhas = (await conn.execute(consulta_fila_feed(config.id))).all()
+    return 200, montar_fila_feed(seq_atual, desde, linhas)
+
+ROTAS_ASSINCRONAS = {
+    'horarios_ocupados': horarios_ocupados,
+    'verificar_notificacoes': verificar_notificacoes,
+    'api_fila_status': api_fila_status,
+    'api_agendamento_status': api_agendamento_status,
+    'api_fila_feed': api_fila_feed,
+}
+
+async def enviar_json(send, status, corpo, headers=()):
+    dados = flask_app.json.dumps(corpo).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(dados)).encode())] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': dados})
+
+async def atender(req, send):
+    slug = req.view_args.get('slug')
+    sessao_id = req.sessao.get('_user_id') or req.sessao.get('cliente_telefone')
+    if isinstance(limitador, BaldeSQLite):
+        admissao = await asyncio.to_thread(verificar_admissao, req.endpoint, 'GET', req.ip, sessao_id, slug)
+    else:
+        admissao = verificar_admissao(req.endpoint, 'GET', req.ip, sessao_id, slug)
+    if admissao is not None:
+        status, espera = admissao
+        mensagem = 'Muitas requisições. Tente novamente em instantes.' if status == 429 else 'Sistema sobrecarregado. Tente novamente em instantes.'
+        await enviar_json(send, status, {'erro': mensagem}, [(b'retry-after', str(max(1, math.ceil(espera))).encode())])
+        return
+
+    config = await buscar_config(slug)
+    if config is None:
+        await enviar_json(send, 404, {'erro': 'Barbearia não encontrada.'})
+        return
+    status, corpo = await ROTAS_ASSINCRONAS[req.endpoint](req, config)
+    await enviar_json(send, status, corpo)
+
+# O WsgiToAsgi padrão roda tudo numa única thread (thread_sensitive=True), uma página por vez;
+# aqui as páginas do Flask usam um pool próprio, separado do usado por asyncio.to_thread
+pool_flask = ThreadPoolExecutor(max_workers=int(os.environ.get('ASGI_THREADS', 16)), thread_name_prefix='flask')
+
+class _InstanciaWsgi(WsgiToAsgiInstance):
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func,
+                                 thread_sensitive=False, executor=pool_flask)
+
+class WsgiEmPool(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await _InstanciaWsgi(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+flask_asgi = WsgiEmPool(flask_app)
+
+async def app_asgi(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            mensagem = await receive()
+            if mensagem['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif mensagem['type'] == 'lifespan.shutdown':
+                await engine.dispose()
+                pool_flask.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] == 'http' and scope['path'].startswith('/api/') and scope['method'] == 'GET':
+        try:
+            endpoint, view_args = flask_app.url_map.bind('').match(scope['path'], method='GET')
+        except (NotFound, MethodNotAllowed):
+            endpoint = None
+        if endpoint in ROTAS_ASSINCRONAS:
+            await atender(Requisicao(scope, endpoint, view_args), send)
+            return
+
+    await flask_asgi(scope, receive, send)
+
+app = app_asgi